@@ -1,38 +1,188 @@
 # bot_webhook.py
 # Обновлённая версия под "Выпуск РФ" и "Выпуск ППИ" с мульти-циклом продукции
 import os
+import io
+import re
+import sys
+import hmac
+import secrets
+import argparse
+import csv
 import json
+import struct
+import cProfile
+import pstats
+import queue
+import atexit
+import signal
+import sqlite3
 import logging
+import logging.handlers
+import tempfile
+import traceback
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, Iterable, Iterator
 
-from flask import Flask, request
+from flask import Flask, request, jsonify
 import gspread
 from google.oauth2 import service_account
 from filelock import FileLock
+import openpyxl
 import requests
 
-logging.basicConfig(level=logging.INFO)
+# ========== Logging: очередь + фоновый писатель, JSON ==========
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = 10000
+EXC_LOG_WINDOW = 60       # окно для повторяющихся исключений, сек
+EXC_LOG_FULL = 3          # сколько раз за окно писать полный traceback
+EXC_LOG_SAMPLE = 50       # дальше — каждое N-е, без traceback
+
+_log_local = threading.local()
+
+
+def set_log_context(**fields):
+    """Поля (uid, flow, step, update_id) для всех записей лога текущего потока."""
+    ctx = getattr(_log_local, "ctx", None)
+    if ctx is None:
+        ctx = _log_local.ctx = {}
+    ctx.update({k: v for k, v in fields.items() if v is not None})
+
+
+def clear_log_context():
+    _log_local.ctx = None
+
+
+class _ExceptionSampler(logging.Filter):
+    """Ограничивает поток одинаковых исключений: полный traceback только первые EXC_LOG_FULL раз за окно."""
+
+    def __init__(self):
+        super().__init__()
+        self._seen: Dict[Tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not record.exc_info or not record.exc_info[1]:
+            return True
+        exc = record.exc_info[1]
+        key = (type(exc).__name__, str(exc)[:200], record.pathname, record.lineno)
+        now_ts = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None or now_ts - entry[0] > EXC_LOG_WINDOW:
+                if len(self._seen) > 1000:
+                    self._seen.clear()
+                entry = self._seen[key] = [now_ts, 0]
+            entry[1] += 1
+            count = entry[1]
+        if count <= EXC_LOG_FULL:
+            return True
+        if count % EXC_LOG_SAMPLE:
+            return False
+        record.exc_info = None
+        record.repeated = count
+        return True
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт запись в очередь: сообщение и traceback форматируются здесь, чтобы в очереди
+    не жили args и объекты исключений (их могут изменить до записи), JSON собирается
+    в потоке QueueListener. При переполнении запись отбрасывается, а не ждёт.
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        record.ctx = dict(getattr(_log_local, "ctx", None) or {})
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _AsyncQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        doc.update(getattr(record, "ctx", None) or {})
+        for key in ("duration_ms", "repeated"):
+            if hasattr(record, key):
+                doc[key] = getattr(record, key)
+        if record.exc_text:
+            doc["exc"] = record.exc_text
+        elif record.exc_info:
+            doc["exc"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        if _AsyncQueueHandler.dropped:
+            doc["dropped"] = _AsyncQueueHandler.dropped
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _AsyncQueueHandler(log_queue)
+    handler.addFilter(_ExceptionSampler())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+_log_listener = setup_logging()
 log = logging.getLogger("bot")
 
 # ========== ENV ==========
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 GOOGLE_CREDS_JSON = os.getenv("GOOGLE_CREDS_JSON")
-
-if not all([TELEGRAM_TOKEN, SPREADSHEET_ID, GOOGLE_CREDS_JSON]):
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")  # без него /debug/* недоступны
+# Несколько площадок (таблиц) в одном процессе, см. SiteRouter
+SITES_JSON = os.getenv("SITES_JSON")
+SHEETS_QUOTA_PER_MIN = int(os.getenv("SHEETS_QUOTA_PER_MIN", "60"))
+SHEETS_QUOTA_MAX_WAIT = float(os.getenv("SHEETS_QUOTA_MAX_WAIT", "2"))  # дольше не ждём квоту (сидим под FileLock)
+SHEETS_BACKGROUND_RESERVE = 0.5  # доля квоты, которую фоновые задачи (выгрузка) оставляют вебхуку
+# Регистрация вебхука (см. WebhookManager)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "10"))
+WEBHOOK_AUTO_REGISTER = os.getenv("WEBHOOK_AUTO_REGISTER", "0") == "1"
+# Очередь исходящих сообщений/записей; на Render путь должен быть на persistent disk
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "/tmp/bot_outbox.sqlite3")
+SESSION_INDEX_PATH = os.getenv("SESSION_INDEX_PATH", "/tmp/bot_sessions.sqlite3")
+DRAIN_DEADLINE = float(os.getenv("DRAIN_DEADLINE", "20"))
+
+if not TELEGRAM_TOKEN:
     raise RuntimeError("Missing required env vars")
 
 # ========== Google Sheets init ==========
-creds_dict = json.loads(GOOGLE_CREDS_JSON)
-creds = service_account.Credentials.from_service_account_info(
-    creds_dict,
-    scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-)
-gc = gspread.authorize(creds)
-sh = gc.open_by_key(SPREADSHEET_ID)
+def authorize_gspread(creds_json: str) -> gspread.Client:
+    creds = service_account.Credentials.from_service_account_info(
+        json.loads(creds_json),
+        scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    )
+    return gspread.authorize(creds)
+
 
 # ========== Time helpers ==========
 MSK = timezone(timedelta(hours=3))
@@ -46,6 +196,128 @@ def now_msk_str() -> str:
     return now_msk().strftime("%Y-%m-%d %H:%M:%S")
 
 
+# ========== Profiling & slow-update tracing ==========
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+SLOW_UPDATES_KEEP = 100
+
+_trace_local = threading.local()
+SLOW_UPDATES: deque = deque(maxlen=SLOW_UPDATES_KEEP)
+
+
+@contextmanager
+def trace_stage(name: str):
+    """Замеряет этап обработки текущего апдейта (ожидание лока, вызовы Sheets/Telegram)."""
+    tr = getattr(_trace_local, "trace", None)
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr["stages"].append((name, round((time.perf_counter() - t0) * 1000, 1)))
+
+
+class Profiler:
+    """cProfile для следующих N апдейтов и/или T секунд; статистика суммируется."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+        self.remaining = 0
+        self.until = 0.0
+        self.profiled = 0
+        self.stats: Optional[pstats.Stats] = None
+
+    def arm(self, updates: int = 0, seconds: float = 0):
+        with self._lock:
+            self.remaining = updates
+            self.until = time.time() + seconds if seconds else 0.0
+            self.profiled = 0
+            self.stats = None
+
+    def _take(self) -> bool:
+        with self._lock:
+            if self.until and time.time() > self.until:
+                self.until = 0.0
+                self.remaining = 0
+            if not self.until and self.remaining <= 0:
+                return False
+            if self.remaining > 0:
+                self.remaining -= 1
+            return True
+
+    @contextmanager
+    def maybe_profile(self):
+        # В процессе может быть активен только один cProfile (с 3.12 второй enable() даёт ValueError),
+        # поэтому параллельные апдейты, пока один профилируется, идут без профиля.
+        prof = None
+        if self._active.acquire(blocking=False):
+            if self._take():
+                prof = cProfile.Profile()
+                try:
+                    prof.enable()
+                except ValueError as e:
+                    log.warning("Profiler skipped: %s", e)
+                    prof = None
+            if prof is None:
+                self._active.release()
+        try:
+            yield
+        finally:
+            if prof is not None:
+                prof.disable()
+                self._active.release()
+                self._merge(prof)
+
+    def _merge(self, prof: cProfile.Profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(prof)
+            else:
+                self.stats.add(prof)
+            self.profiled += 1
+
+    def status(self) -> Dict[str, Any]:
+        return {"armed": bool(self.remaining > 0 or self.until > time.time()),
+                "remaining_updates": self.remaining,
+                "seconds_left": max(0, round(self.until - time.time(), 1)) if self.until else 0,
+                "profiled_updates": self.profiled}
+
+    def report(self, sort: str = "cumulative", limit: int = 40) -> str:
+        with self._lock:
+            if self.stats is None:
+                return ""
+            out = io.StringIO()
+            self.stats.stream = out
+            self.stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+
+profiler = Profiler()
+
+
+@contextmanager
+def trace_update(update: dict):
+    """Собирает разбивку по этапам для апдейта и сохраняет её, если апдейт оказался медленным."""
+    tr = {"update_id": update.get("update_id"), "stages": []}
+    _trace_local.trace = tr
+    set_log_context(update_id=update.get("update_id"))
+    t0 = time.perf_counter()
+    try:
+        with profiler.maybe_profile():
+            yield tr
+    finally:
+        _trace_local.trace = None
+        total = (time.perf_counter() - t0) * 1000
+        log.info("update handled", extra={"duration_ms": round(total, 1)})
+        clear_log_context()
+        if total >= SLOW_UPDATE_MS:
+            tr["total_ms"] = round(total, 1)
+            tr["at"] = now_msk_str()
+            SLOW_UPDATES.append(tr)
+
+
 # ========== Sheet names & headers ==========
 # New production sheets
 RF_SHEET = "Выпуск РФ"       # Ротационное формование
@@ -57,27 +329,194 @@ CTRL_PPI_SHEET = "Контр_Выпуск_ППИ"
 USERS_SHEET = "Пользователи"
 
 # Headers for the new sheets:
-# Date | Shift | Product | Quantity | User | TS | Status
-PROD_HEADERS = ["Дата", "Смена", "Продукция", "Количество", "Пользователь", "Время отправки", "Статус"]
+# Date | Shift | Product | Quantity | User | TS | Status | Session id
+PROD_HEADERS = ["Дата", "Смена", "Продукция", "Количество", "Пользователь", "Время отправки", "Статус", "Сессия"]
 USERS_HEADERS = ["TelegramID", "ФИО", "Роль", "Статус", "Запросил у", "Дата создания", "Подтвердил", "Дата подтверждения"]
 
 # ========== Telegram send wrapper ==========
+def tg_call(method: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", 10)
+    with trace_stage(f"tg.{method}"):
+        return requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/{method}", **kwargs)
+
+
 def tg_send(chat_id: int, text: str, markup: Optional[dict] = None):
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     if markup:
         payload["reply_markup"] = json.dumps(markup, ensure_ascii=False)
     try:
-        requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage", json=payload, timeout=10)
+        tg_call("sendMessage", json=payload)
     except Exception as e:
         log.exception("tg_send error: %s", e)
 
 
+def tg_download_file(file_id: str, max_bytes: int) -> requests.Response:
+    """
+    Возвращает потоковый ответ с содержимым файла Telegram (getFile + download).
+    Бросает ValueError, если файл больше max_bytes.
+    """
+    r = tg_call("getFile", json={"file_id": file_id})
+    info = r.json().get("result") or {}
+    if not info.get("file_path"):
+        raise ValueError("file_path not returned by getFile")
+    if int(info.get("file_size") or 0) > max_bytes:
+        raise ValueError("file too large")
+    with trace_stage("tg.download"):
+        resp = requests.get(f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{info['file_path']}", stream=True, timeout=30)
+    resp.raise_for_status()
+    return resp
+
+
+# ========== Webhook registration ==========
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+MAX_UPDATE_BYTES = 256 * 1024
+
+
+class WebhookManager:
+    """
+    Регистрирует вебхук с узким allowed_updates, max_connections и secret_token.
+    ensure() вызывает setWebhook, если текущие настройки отличаются; с секретом — всегда:
+    secret_token Telegram не возвращает, и после его смены вебхук отвечал бы 403 на все апдейты.
+    """
+
+    def __init__(self, url: Optional[str], secret: Optional[str], max_connections: int):
+        self.url = url
+        self.secret = secret
+        self.max_connections = max_connections
+
+    def info(self) -> Dict[str, Any]:
+        return tg_call("getWebhookInfo").json().get("result") or {}
+
+    def set(self, drop_pending: bool = False) -> Dict[str, Any]:
+        if not self.url:
+            raise RuntimeError("WEBHOOK_URL is not set")
+        payload = {"url": self.url, "allowed_updates": ALLOWED_UPDATES,
+                   "max_connections": self.max_connections, "drop_pending_updates": drop_pending}
+        if self.secret:
+            payload["secret_token"] = self.secret
+        return tg_call("setWebhook", json=payload).json()
+
+    def delete(self, drop_pending: bool = False) -> Dict[str, Any]:
+        return tg_call("deleteWebhook", json={"drop_pending_updates": drop_pending}).json()
+
+    def ensure(self) -> bool:
+        try:
+            if not self.secret:
+                info = self.info()
+                if (info.get("url") == self.url
+                        and sorted(info.get("allowed_updates") or []) == sorted(ALLOWED_UPDATES)
+                        and info.get("max_connections") == self.max_connections):
+                    return False
+            res = self.set()
+            log.info("Webhook registered: %s", res)
+            return True
+        except Exception:
+            log.exception("Webhook registration failed")
+            return False
+
+
+webhook_manager = WebhookManager(WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS)
+
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Production bot webhook")
+    sub = parser.add_subparsers(dest="cmd")
+    wh = sub.add_parser("webhook", help="manage Telegram webhook registration")
+    wh.add_argument("action", choices=["set", "delete", "info"])
+    wh.add_argument("--drop-pending", action="store_true")
+    return parser
+
+
+def run_webhook_command(args: argparse.Namespace):
+    if args.action == "set":
+        res = webhook_manager.set(drop_pending=args.drop_pending)
+    elif args.action == "delete":
+        res = webhook_manager.delete(drop_pending=args.drop_pending)
+    else:
+        res = webhook_manager.info()
+    print(json.dumps(res, ensure_ascii=False, indent=2))
+
+
+# CLI "webhook ..." нужен только Telegram — выполняем до подключения к таблицам, фоновых потоков и SIGTERM
+if __name__ == "__main__" and sys.argv[1:2] == ["webhook"]:
+    run_webhook_command(build_cli_parser().parse_args(sys.argv[1:]))
+    sys.exit(0)
+
+if not all([SPREADSHEET_ID, GOOGLE_CREDS_JSON]):
+    raise RuntimeError("Missing required env vars")
+
+
 # ========== SheetClient — encapsulate sheet ops + caching ==========
+class QuotaExceeded(Exception):
+    """Квота Sheets API исчерпана настолько, что ждать пришлось бы дольше max_wait."""
+
+
+class QuotaGovernor:
+    """
+    Token bucket на запросы к Sheets API: не больше per_min запросов в минуту, остальные ждут,
+    но не дольше max_wait секунд — иначе QuotaExceeded. Один на сервисный аккаунт (квота у Google на ключ).
+    Фоновые запросы (reserve > 0) ждут без ограничения и берут токен, только пока в ведре
+    остаётся reserve токенов для интерактивных.
+    """
+
+    def __init__(self, per_min: int, max_wait: float = SHEETS_QUOTA_MAX_WAIT):
+        self.rate = per_min / 60.0
+        self.capacity = float(per_min)
+        self.tokens = float(per_min)
+        self.updated = time.monotonic()
+        self.max_wait = max_wait
+        self.background_reserve = min(self.capacity - 1, self.capacity * SHEETS_BACKGROUND_RESERVE)
+        self._lock = threading.Lock()
+
+    def acquire(self, reserve: float = 0.0):
+        deadline = None if reserve else time.monotonic() + self.max_wait
+        need = 1 + reserve
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= need:
+                    self.tokens -= 1
+                    return
+                wait = (need - self.tokens) / self.rate
+                if deadline is not None and now + wait > deadline:
+                    raise QuotaExceeded(f"Sheets quota exhausted, next slot in {wait:.1f}s")
+            with trace_stage("sheets.quota_wait"):
+                time.sleep(wait)
+
+
+class _TracedWorksheet:
+    """Обёртка над gspread.Worksheet: каждый вызов API проходит через квоту и попадает в trace_stage."""
+
+    def __init__(self, ws, governor: QuotaGovernor, reserve: float = 0.0):
+        self._ws = ws
+        self._governor = governor
+        self._reserve = reserve
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._ws, name)
+        if not callable(attr):
+            return attr
+        title = self._ws.title
+
+        def call(*args, **kwargs):
+            self._governor.acquire(self._reserve)
+            with trace_stage(f"sheets.{name} {title}"):
+                return attr(*args, **kwargs)
+        return call
+
+
 class SheetClient:
-    def __init__(self, sh_obj, cache_ttl: int = 5):
+    def __init__(self, sh_obj, cache_ttl: int = 5, site: str = "default", governor: Optional[QuotaGovernor] = None):
         self.sh = sh_obj
+        self.site = site
+        self.spreadsheet_id = sh_obj.id
         self.cache_ttl = cache_ttl
+        self.governor = governor or QuotaGovernor(SHEETS_QUOTA_PER_MIN)
         self._cache: Dict[str, Dict[str, Any]] = {}
+        self.controllers_cache: Dict[str, Any] = {"rf": {"until": 0, "data": []}, "ppi": {"until": 0, "data": []}}
+        self.product_indexes: Dict[str, "ProductIndex"] = {}
         # ensure sheets & headers
         self._ensure_sheet(RF_SHEET, PROD_HEADERS)
         self._ensure_sheet(PPI_SHEET, PROD_HEADERS)
@@ -93,12 +532,20 @@ class SheetClient:
             ws = self.sh.add_worksheet(title=title, rows=3000, cols=20)
         if headers:
             current = ws.row_values(1)
-            if current != headers:
+            if current and current == headers[:len(current)]:
+                # старый заголовок без новых столбцов — дописываем, данные не трогаем
+                if len(current) < len(headers):
+                    ws.update("A1", [headers])
+            elif current != headers:
                 ws.clear()
                 ws.insert_row(headers, 1)
 
-    def _ws(self, title: str):
-        return self.sh.worksheet(title)
+    def _ws(self, title: str, background: bool = False):
+        """background=True — для фоновых задач: запросы ждут квоту, оставляя запас вебхуку."""
+        reserve = self.governor.background_reserve if background else 0.0
+        self.governor.acquire(reserve)
+        with trace_stage(f"sheets.worksheet {title}"):
+            return _TracedWorksheet(self.sh.worksheet(title), self.governor, reserve)
 
     def _get_all_values_cached(self, title: str) -> List[List[str]]:
         now_ts = time.time()
@@ -107,10 +554,15 @@ class SheetClient:
             return c["data"]
         try:
             data = self._ws(title).get_all_values()
+        except QuotaExceeded:
+            if c:
+                log.warning("Sheets quota exhausted, serving stale %s", title)
+                return c["data"]
+            raise
         except Exception as e:
             log.exception("Error reading sheet %s: %s", title, e)
             data = []
-        self._cache[title] = {"data": data, "until": now_ts + self.cache_ttl}
+        self._cache[title] = {"data": data, "until": now_ts + self.cache_ttl, "read_at": now_ts}
         return data
 
     def invalidate_cache(self, title: Optional[str] = None):
@@ -119,6 +571,32 @@ class SheetClient:
         else:
             self._cache.clear()
 
+    def cache_items(self, titles: Iterable[str], max_age: float) -> Dict[str, Dict[str, Any]]:
+        """Данные кэша с временем чтения из таблицы; записи старше max_age пропускаются."""
+        now_ts = time.time()
+        res = {}
+        for title in titles:
+            c = self._cache.get(title)
+            if c and c.get("data") and now_ts - c.get("read_at", 0) <= max_age:
+                res[title] = {"data": c["data"], "read_at": c["read_at"]}
+        return res
+
+    def refresh(self, title: str) -> bool:
+        """Перечитывает лист в кэш; при ошибке оставляет прежние данные и возвращает False."""
+        try:
+            data = self._ws(title).get_all_values()
+        except Exception as e:
+            log.exception("Error refreshing sheet %s: %s", title, e)
+            return False
+        now_ts = time.time()
+        self._cache[title] = {"data": data, "until": now_ts + self.cache_ttl, "read_at": now_ts}
+        return True
+
+    def load_cache(self, items: Dict[str, Dict[str, Any]], until: float):
+        """Заполняет кэш готовыми данными (например, из снапшота) до момента until."""
+        for title, c in items.items():
+            self._cache.setdefault(title, {"data": c["data"], "until": until, "read_at": c["read_at"]})
+
     # Users operations
     def get_users_rows(self) -> List[List[str]]:
         return self._get_all_values_cached(USERS_SHEET)
@@ -198,6 +676,77 @@ class SheetClient:
         except Exception as e:
             log.exception("append_record error: %s", e)
 
+    def append_records(self, sheet_title: str, rows: List[List[Any]]) -> Optional[Tuple[int, int]]:
+        """
+        Добавляет несколько строк одним запросом (append_rows).
+        Возвращает номера (первой, последней) записанной строки или None при ошибке.
+        """
+        if not rows:
+            return None
+        try:
+            res = self._ws(sheet_title).append_rows(rows, value_input_option="USER_ENTERED")
+            self.invalidate_cache(sheet_title)
+        except Exception as e:
+            log.exception("append_records error: %s", e)
+            return None
+        m = re.search(r"!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$", ((res or {}).get("updates") or {}).get("updatedRange", ""))
+        if not m:
+            return (0, 0)
+        first = int(m.group(1))
+        return first, int(m.group(2) or first)
+
+    def get_range(self, sheet_title: str, a1: str) -> Optional[List[List[str]]]:
+        """Значения диапазона; None при ошибке чтения (в т.ч. исчерпана квота) — не путать с пустым диапазоном."""
+        try:
+            return self._ws(sheet_title).get(a1)
+        except Exception as e:
+            log.exception("get_range(%s, %s) error: %s", sheet_title, a1, e)
+            return None
+
+    def mark_rows_canceled(self, sheet_title: str, rownums: List[int]) -> bool:
+        """Ставит ОТМЕНЕНО в столбец G всем строкам одним batch-запросом."""
+        try:
+            self._ws(sheet_title).batch_update([{"range": f"G{r}", "values": [["ОТМЕНЕНО"]]} for r in rownums])
+            self.invalidate_cache(sheet_title)
+            return True
+        except Exception as e:
+            log.exception("mark_rows_canceled error: %s", e)
+            return False
+
+    def find_written_session(self, sheet_title: str, session_id: str) -> Optional[Tuple[int, int]]:
+        """(первая, последняя) строка сессии, уже записанной в лист; читает столбец H без кэша, ошибки пробрасывает."""
+        col = self._ws(sheet_title).col_values(8)
+        found = [i + 1 for i, v in enumerate(col) if i and v == session_id]
+        return (found[0], found[-1]) if found else None
+
+    def find_session_rows(self, sheet_title: str, session_id: str) -> Optional[Tuple[List[int], List[List[str]]]]:
+        """
+        Номера строк с данным id сессии (столбец H) и весь лист — запасной путь, если строки сдвинули.
+        Читает без кэша; None при ошибке чтения.
+        """
+        try:
+            vals = self._ws(sheet_title).get_all_values()
+        except Exception as e:
+            log.exception("find_session_rows(%s) error: %s", sheet_title, e)
+            return None
+        return [i + 1 for i, row in enumerate(vals) if i and len(row) > 7 and row[7] == session_id], vals
+
+    def iter_rows(self, sheet_title: str, page_size: int = 2000) -> Iterator[List[str]]:
+        """
+        Постранично читает строки данных листа (без заголовка) диапазонами A:H,
+        не загружая весь лист в память. Страницы читаются в фоновом режиме квоты.
+        """
+        ws = self._ws(sheet_title, background=True)
+        # API обрезает пустые строки в конце диапазона, поэтому короткая страница
+        # ещё не конец листа — идём до row_count
+        total = ws.row_count
+        start = 2
+        while start <= total:
+            end = min(start + page_size - 1, total)
+            page = ws.get(f"A{start}:H{end}")
+            yield from page
+            start = end + 1
+
     def get_last_records(self, sheet_title: str, n: int = 5) -> List[List[str]]:
         """
         Возвращает последние n АКТИВНЫХ записей (без ОТМЕНЕНО).
@@ -229,10 +778,11 @@ class SheetClient:
 
     def find_last_session_records(self, sheet_title: str, uid: int) -> List[Tuple[List[str], int]]:
         """
-        Находит последнюю активную сессию пользователя в листе по TS (Время отправки).
+        Находит последнюю активную сессию пользователя в листе: по id сессии (столбец H),
+        а для старых строк без id — по TS (Время отправки).
         Возвращает список кортежей (row, row_number) для всех строк, относящихся к этой сессии,
         где пользователь встречается как "(<uid>)" в столбце Пользователь и статус != "ОТМЕНЕНО".
-        Формат листа: 0:Дата,1:Смена,2:Продукция,3:Количество,4:Пользователь,5:Время отправки,6:Статус
+        Формат листа: 0:Дата,1:Смена,2:Продукция,3:Количество,4:Пользователь,5:Время отправки,6:Статус,7:Сессия
         """
         vals = self._get_all_values_cached(sheet_title)
         if not vals or len(vals) <= 1:
@@ -240,6 +790,7 @@ class SheetClient:
         user_idx = 4
         ts_idx = 5
         status_idx = 6
+        session_idx = 7
 
         # найдем индекс последней строки, принадлежащей пользователю и не отмененной
         last_row_index = None
@@ -260,8 +811,15 @@ class SheetClient:
         if last_row_index is None:
             return []
 
-        # получить TS у этой строки
         last_row = vals[last_row_index]
+        session_id = last_row[session_idx] if len(last_row) > session_idx else ""
+        if session_id:
+            # сессии с id: TS совпадает у разных сессий, отправленных в одну секунду
+            return [(row, i + 1) for i, row in enumerate(vals)
+                    if i and len(row) > session_idx and row[session_idx] == session_id
+                    and row[status_idx].strip() != "ОТМЕНЕНО"]
+
+        # получить TS у этой строки
         ts_value = last_row[ts_idx] if len(last_row) > ts_idx else None
         if not ts_value:
             # если TS нет, вернём только ту последнюю строку
@@ -284,8 +842,49 @@ class SheetClient:
 
 
 
-# instantiate
-sheet_client = SheetClient(sh, cache_ttl=5)
+# ========== SiteRouter — several spreadsheets (plants) in one process ==========
+class SiteRouter:
+    """
+    Маршрутизация пользователей и потоков по таблицам площадок. SITES_JSON:
+    {"sites": {"plant2": "<spreadsheet_id>" | {"id": "...", "creds_env": "GOOGLE_CREDS_JSON_PLANT2",
+               "quota_per_min": 60}},
+     "users": {"<telegram_id>": "plant2"}, "flows": {"ppi": "plant2"}}
+    Площадка "default" — SPREADSHEET_ID. Привязка пользователя важнее привязки потока.
+    У каждой площадки свой SheetClient (кэши, справочники), а квота — общая на сервисный аккаунт:
+    площадки без creds_env делят SHEETS_QUOTA_PER_MIN основного ключа, quota_per_min задаёт квоту ключа creds_env.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        # creds_env ("" — основной ключ) -> (gspread-клиент, квота)
+        self.credentials: Dict[str, Tuple[Any, QuotaGovernor]] = {"": (gc, QuotaGovernor(SHEETS_QUOTA_PER_MIN))}
+        self.clients: Dict[str, SheetClient] = {
+            "default": SheetClient(gc.open_by_key(SPREADSHEET_ID), cache_ttl=5, governor=self.credentials[""][1])}
+        for name, spec in (config.get("sites") or {}).items():
+            if isinstance(spec, str):
+                spec = {"id": spec}
+            creds_env = spec.get("creds_env") or ""
+            if creds_env not in self.credentials:
+                self.credentials[creds_env] = (authorize_gspread(os.environ[creds_env]),
+                                               QuotaGovernor(int(spec.get("quota_per_min", SHEETS_QUOTA_PER_MIN))))
+            client, governor = self.credentials[creds_env]
+            self.clients[name] = SheetClient(client.open_by_key(spec["id"]), cache_ttl=5, site=name, governor=governor)
+        self.user_sites: Dict[str, str] = {str(k): v for k, v in (config.get("users") or {}).items()}
+        self.flow_sites: Dict[str, str] = dict(config.get("flows") or {})
+        for site in list(self.user_sites.values()) + list(self.flow_sites.values()):
+            if site not in self.clients:
+                raise RuntimeError(f"Unknown site in SITES_JSON: {site}")
+
+    @property
+    def default(self) -> SheetClient:
+        return self.clients["default"]
+
+    def for_user(self, uid: int, flow: Optional[str] = None) -> SheetClient:
+        site = self.user_sites.get(str(uid)) or (self.flow_sites.get(flow) if flow else None) or "default"
+        return self.clients[site]
+
+
+gc = authorize_gspread(GOOGLE_CREDS_JSON)
+sites = SiteRouter(json.loads(SITES_JSON) if SITES_JSON else {})
 
 # ========== Keyboards & helpers ==========
 def kb_reply(rows: List[List[str]], one_time: bool = False, placeholder: Optional[str] = None, input_field_placeholder: Optional[str] = None) -> dict:
@@ -298,9 +897,10 @@ def kb_reply(rows: List[List[str]], one_time: bool = False, placeholder: Optiona
 
 
 MAIN_KB = kb_reply([["Ротационное формование", "Полимерно-песчаное производство"]])
-FLOW_MENU_KB = kb_reply([["Новая запись"], ["Отменить последнюю запись"], ["Назад"]])
+FLOW_MENU_KB = kb_reply([["Новая запись"], ["Отменить последнюю запись"], ["Импорт из файла"], ["Назад"]])
 CANCEL_KB = kb_reply([["Отмена"]])
 CONFIRM_KB = kb_reply([["Да, отменить"], ["Нет, оставить"]])
+IMPORT_CONFIRM_KB = kb_reply([["Да, импортировать"], ["Отмена"]])
 
 # Numeric input keyboard (opens numeric keypad on phone; user types digits manually)
 NUMERIC_INPUT_KB = {
@@ -312,51 +912,848 @@ NUMERIC_INPUT_KB = {
     "input_field_placeholder": "Введите число"
 }
 
-# Product keyboards builder — reads first column of given sheet
-def build_product_kb(sheet_name: str, extra: Optional[List[str]] = None) -> dict:
-    if extra is None:
-        extra = []
+# ========== Product search index (inline mode) ==========
+PRODUCT_KB_MAX = 30          # больше позиций — в клавиатуре только недавние + inline-поиск
+PRODUCT_INDEX_TTL = 300
+PREFIX_MAX = 8
+INLINE_RESULTS_LIMIT = 20
+RECENT_PRODUCTS_KEEP = 30
+
+
+def _norm(s: str) -> str:
+    return " ".join(s.lower().replace("ё", "е").split())
+
+
+def _trigrams(s: str) -> set:
+    s = f" {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class ProductIndex:
+    """
+    Индекс справочника продукции: префиксы слов (до PREFIX_MAX символов) и триграммы
+    для поиска по подстроке. Обновляется инкрементально — по разнице со старым списком.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.names: Dict[int, str] = {}
+        self._ids: Dict[str, int] = {}
+        self._next_id = 0
+        self._prefix: Dict[str, set] = {}
+        self._tri: Dict[str, set] = {}
+        self.loaded_at = 0.0
+
+    def _keys(self, name: str) -> Tuple[set, set]:
+        n = _norm(name)
+        prefixes = {w[:i] for w in n.split() for i in range(1, min(len(w), PREFIX_MAX) + 1)}
+        return prefixes, _trigrams(n)
+
+    def update(self, names: List[str]):
+        with self._lock:
+            new = set(names)
+            old = set(self._ids)
+            for name in old - new:
+                pid = self._ids.pop(name)
+                self.names.pop(pid, None)
+                prefixes, tris = self._keys(name)
+                for k in prefixes:
+                    self._prefix.get(k, set()).discard(pid)
+                for k in tris:
+                    self._tri.get(k, set()).discard(pid)
+            for name in new - old:
+                pid = self._next_id
+                self._next_id += 1
+                self._ids[name] = pid
+                self.names[pid] = name
+                prefixes, tris = self._keys(name)
+                for k in prefixes:
+                    self._prefix.setdefault(k, set()).add(pid)
+                for k in tris:
+                    self._tri.setdefault(k, set()).add(pid)
+            self.loaded_at = time.time()
+
+    def search(self, query: str, recent: Optional[Dict[str, int]] = None, limit: int = INLINE_RESULTS_LIMIT) -> List[Tuple[int, str]]:
+        recent = recent or {}
+        q = _norm(query)
+        words = q.split()
+        with self._lock:
+            ids = set(self.names)
+            for w in words:
+                ids &= self._prefix.get(w[:PREFIX_MAX], set())
+                if not ids:
+                    break
+            if any(len(w) > PREFIX_MAX for w in words):
+                ids = {i for i in ids if all(any(nw.startswith(w) for nw in _norm(self.names[i]).split()) for w in words)}
+            if not ids and len(q) >= 3:
+                # поиск по середине слова — триграммы + проверка подстроки
+                ids = set(self.names)
+                for t in {q[i:i + 3] for i in range(len(q) - 2)}:
+                    ids &= self._tri.get(t, set())
+                    if not ids:
+                        break
+                ids = {i for i in ids if q in _norm(self.names[i])}
+            items = [(i, self.names[i]) for i in ids]
+        items.sort(key=lambda it: (-recent.get(it[1], 0), not _norm(it[1]).startswith(q), len(it[1]), it[1]))
+        return items[:limit]
+
+
+_RECENT_PRODUCTS: Dict[int, deque] = {}
+
+
+def get_product_index(sc: SheetClient, sheet_name: str, wait: bool = True) -> ProductIndex:
+    """wait=False — не ждать первой загрузки справочника (inline): вернуть пустой индекс и грузить в фоне."""
+    idx = sc.product_indexes.get(sheet_name)
+    if idx is None:
+        idx = sc.product_indexes[sheet_name] = ProductIndex()
+        if wait:
+            load_product_catalog(sc, sheet_name)
+        else:
+            idx.loaded_at = time.time()
+            threading.Thread(target=load_product_catalog, args=(sc, sheet_name), daemon=True).start()
+    elif time.time() - idx.loaded_at > PRODUCT_INDEX_TTL:
+        # не задерживаем inline-ответ: обновим справочник в фоне
+        idx.loaded_at = time.time()
+        threading.Thread(target=load_product_catalog, args=(sc, sheet_name), daemon=True).start()
+    return idx
+
+
+def record_recent_product(uid: int, product: str):
+    _RECENT_PRODUCTS.setdefault(uid, deque(maxlen=RECENT_PRODUCTS_KEEP)).append(product)
+
+
+def recent_product_scores(uid: int) -> Dict[str, int]:
+    """Вес продукта для пользователя: чем чаще и позже выбирался, тем выше."""
+    scores: Dict[str, int] = {}
+    for pos, name in enumerate(_RECENT_PRODUCTS.get(uid, ())):
+        scores[name] = scores.get(name, 0) + pos + 1
+    return scores
+
+
+_BOT_USERNAME: Dict[str, str] = {}
+
+
+def get_bot_username() -> str:
+    if "name" not in _BOT_USERNAME:
+        try:
+            _BOT_USERNAME["name"] = tg_call("getMe").json()["result"]["username"]
+        except Exception:
+            log.exception("getMe failed")
+            return ""
+    return _BOT_USERNAME["name"]
+
+
+def product_search_hint(sc: SheetClient, sheet_name: str) -> str:
+    if len(get_product_index(sc, sheet_name).names) <= PRODUCT_KB_MAX:
+        return ""
+    username = get_bot_username()
+    if not username:
+        return ""
+    return f"\n\nПоиск по справочнику: введите <code>@{username} </code> и начало названия."
+
+
+def answer_inline_query(iq: dict, flow: Optional[str]):
+    uid = iq["from"]["id"]
+    results = []
+    if auth.is_approved(uid):
+        flows = [flow] if flow else ["rf", "ppi"]
+        recent = recent_product_scores(uid)
+        for f in flows:
+            sc = sites.for_user(uid, f)
+            sheet_name = "Продукция РФ" if f == "rf" else "Продукция ППИ"
+            for pid, name in get_product_index(sc, sheet_name, wait=False).search(iq.get("query", ""), recent):
+                results.append({
+                    "type": "article",
+                    "id": f"{f}{pid}",
+                    "title": name,
+                    "input_message_content": {"message_text": name},
+                })
     try:
-        vals = sheet_client._ws(sheet_name).col_values(1)[1:]
+        tg_call("answerInlineQuery", json={"inline_query_id": iq["id"], "results": results[:INLINE_RESULTS_LIMIT],
+                                           "cache_time": 5, "is_personal": True})
+    except Exception:
+        log.exception("answerInlineQuery failed")
+
+
+def load_product_catalog(sc: SheetClient, sheet_name: str) -> List[str]:
+    try:
+        vals = sc._ws(sheet_name).col_values(1)[1:]
     except Exception:
         vals = []
-    items = [v.strip() for v in vals if v and v.strip()] + extra
+    items = [v.strip() for v in vals if v and v.strip()]
+    if vals or sheet_name not in sc.product_indexes:
+        sc.product_indexes.setdefault(sheet_name, ProductIndex()).update(items)
+    return items
+
+
+# Product keyboards builder — reads first column of given sheet
+def build_product_kb(sc: SheetClient, sheet_name: str, extra: Optional[List[str]] = None, uid: Optional[int] = None) -> dict:
+    if extra is None:
+        extra = []
+    items = load_product_catalog(sc, sheet_name)
+    if len(items) > PRODUCT_KB_MAX:
+        # большой справочник: недавние продукты пользователя, остальное — через inline-поиск
+        catalog = set(items)
+        recent = recent_product_scores(uid) if uid is not None else {}
+        items = sorted((p for p in recent if p in catalog), key=lambda p: -recent[p])[:8]
+    items = items + extra
     # split into two columns per row for nicer layout
     rows = [items[i:i + 2] for i in range(0, len(items), 2)]
     rows.append(["Отмена"])
     return kb_reply(rows, one_time=False)
 
 
-# Controllers list (cached)
-_CONTROLLERS_CACHE: Dict[str, Any] = {"rf": {"until": 0, "data": []}, "ppi": {"until": 0, "data": []}}
-def get_controllers_cached(sheet_name: str, ttl: int = 600) -> List[int]:
+# Controllers list (cached per site)
+def get_controllers_cached(sc: SheetClient, sheet_name: str, ttl: int = 600) -> List[int]:
     key = "rf" if sheet_name == CTRL_RF_SHEET else "ppi"
+    cache = sc.controllers_cache
     now_ts = time.time()
-    if _CONTROLLERS_CACHE[key]["until"] > now_ts and _CONTROLLERS_CACHE[key]["data"]:
-        return _CONTROLLERS_CACHE[key]["data"]
+    if cache[key]["until"] > now_ts and cache[key]["data"]:
+        return cache[key]["data"]
     try:
-        data = sheet_client.get_controllers(sheet_name)
+        data = sc.get_controllers(sheet_name)
     except Exception:
         data = []
-    _CONTROLLERS_CACHE[key]["data"] = data
-    _CONTROLLERS_CACHE[key]["until"] = now_ts + ttl
+    cache[key]["data"] = data
+    cache[key]["until"] = now_ts + ttl
+    cache[key]["read_at"] = now_ts
     return data
 
 
+# ========== Cache snapshot (warm start) ==========
+# Файл: MAGIC | версия (u16) | время записи (f64) | длина (u32) | JSON
+# По файлу на площадку: SNAPSHOT_PATH для default, SNAPSHOT_PATH.<site> для остальных.
+# Сохраняются только небольшие горячие данные — пользователи и контролёры; листы выпуска
+# слишком велики и всё равно живут в кэше 5 секунд.
+SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "/tmp/bot_cache.snap")
+SNAPSHOT_MAGIC = b"BOTSNAP\0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sHdI")
+SNAPSHOT_SHEETS = (USERS_SHEET,)
+SNAPSHOT_INTERVAL = 60        # как часто сохранять, сек
+SNAPSHOT_MAX_AGE = 6 * 3600   # данные, прочитанные из таблицы раньше, не сохраняются и не загружаются
+SNAPSHOT_GRACE = 120          # сколько отдавать данные снапшота, если перечитать их при старте не удалось
+
+
+def snapshot_path(sc: SheetClient) -> str:
+    return SNAPSHOT_PATH if sc.site == "default" else f"{SNAPSHOT_PATH}.{sc.site}"
+
+
+def save_cache_snapshot(sc: SheetClient) -> bool:
+    items = sc.cache_items(SNAPSHOT_SHEETS, SNAPSHOT_MAX_AGE)
+    now_ts = time.time()
+    controllers = {k: {"data": v["data"], "read_at": v["read_at"]} for k, v in sc.controllers_cache.items()
+                   if v["data"] and now_ts - v.get("read_at", 0) <= SNAPSHOT_MAX_AGE}
+    if not items and not controllers:
+        return False
+    payload = json.dumps({"spreadsheet": sc.spreadsheet_id, "sheets": items, "controllers": controllers},
+                         ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    path = snapshot_path(sc)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, now_ts, len(payload)))
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return True
+    except Exception:
+        log.exception("save_cache_snapshot failed")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+def read_cache_snapshot(sc: SheetClient) -> Optional[Dict[str, Any]]:
+    """None, если файла нет, он другой версии/таблицы; устаревшие записи отбрасываются."""
+    try:
+        with open(snapshot_path(sc), "rb") as f:
+            magic, version, _, length = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                return None
+            snap = json.loads(f.read(length).decode("utf-8"))
+    except (OSError, ValueError, struct.error):
+        return None
+    if snap.get("spreadsheet") != sc.spreadsheet_id:
+        return None
+    now_ts = time.time()
+    for section in ("sheets", "controllers"):
+        snap[section] = {k: v for k, v in (snap.get(section) or {}).items()
+                         if now_ts - v.get("read_at", 0) <= SNAPSHOT_MAX_AGE}
+    return snap
+
+
+def revalidate_snapshot(sc: SheetClient, snap: Dict[str, Any]):
+    """Сразу перечитывает загруженные из снапшота листы (их немного); до конца чтения отдаётся снапшот."""
+    for title in snap["sheets"]:
+        sc.refresh(title)
+    for key in snap["controllers"]:
+        data = sc.get_controllers(CTRL_RF_SHEET if key == "rf" else CTRL_PPI_SHEET)
+        if data:
+            now_ts = time.time()
+            sc.controllers_cache[key] = {"data": data, "until": now_ts + 600, "read_at": now_ts}
+    log.info("Cache snapshot revalidated (%s)", sc.site)
+
+
+def warm_start_from_snapshot(sc: SheetClient) -> Optional[threading.Thread]:
+    """
+    Загружает кэши площадки из снапшота и запускает (и возвращает) поток перечитывания. Данные
+    снапшота живут не дольше SNAPSHOT_GRACE — если перечитать не удалось, дальше обычный промах кэша.
+    """
+    snap = read_cache_snapshot(sc)
+    if not snap or not (snap["sheets"] or snap["controllers"]):
+        return None
+    until = time.time() + SNAPSHOT_GRACE
+    sc.load_cache(snap["sheets"], until)
+    for key, c in snap["controllers"].items():
+        if key in sc.controllers_cache and not sc.controllers_cache[key]["data"]:
+            sc.controllers_cache[key] = {"data": c["data"], "read_at": c["read_at"], "until": until}
+    log.info("Warm start from cache snapshot (%s): %d sheets", sc.site, len(snap["sheets"]))
+    thread = threading.Thread(target=revalidate_snapshot, args=(sc, snap), daemon=True)
+    thread.start()
+    return thread
+
+
+def snapshot_saver_worker(interval: int = SNAPSHOT_INTERVAL):
+    while True:
+        time.sleep(interval)
+        for sc in sites.clients.values():
+            save_cache_snapshot(sc)
+
+
+# ========== Bulk import (CSV/XLSX) ==========
+# Формат файла: Дата | Смена | Продукция | Количество (строка заголовка необязательна)
+IMPORT_MAX_BYTES = 10 * 1024 * 1024
+IMPORT_MAX_ROWS = 3000
+IMPORT_MAX_ERRORS_SHOWN = 10
+
+
+def _decode_line(raw: bytes) -> str:
+    # Excel в русской локали часто сохраняет CSV в cp1251
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("cp1251", errors="replace")
+
+
+def iter_csv_rows(resp: requests.Response) -> Iterator[List[Any]]:
+    lines = (_decode_line(raw) for raw in resp.iter_lines() if raw is not None)
+    first = next(lines, None)
+    if first is None:
+        return
+    delimiter = ";" if first.count(";") >= first.count(",") else ","
+    yield from csv.reader(chain([first], lines), delimiter=delimiter)
+
+
+def iter_xlsx_rows(resp: requests.Response) -> Iterator[List[Any]]:
+    # xlsx — zip-архив, ему нужен seekable-файл; маленькие файлы остаются в памяти
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as tmp:
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            tmp.write(chunk)
+        tmp.seek(0)
+        wb = openpyxl.load_workbook(tmp, read_only=True, data_only=True)
+        try:
+            for row in wb.worksheets[0].iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            wb.close()
+
+
+def _import_cell(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.strftime("%d.%m.%Y")
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+
+def parse_import_rows(rows: Iterable[List[Any]], catalog: List[str]) -> Tuple[List[Dict[str, str]], List[str]]:
+    """
+    Проверяет строки файла импорта: дата дд.мм.гггг, смена День/Ночь, продукция из справочника, число.
+    Возвращает (валидные позиции, список ошибок). Пустые строки и строка заголовка пропускаются.
+    """
+    by_name = {p.lower(): p for p in catalog}
+    items: List[Dict[str, str]] = []
+    errors: List[str] = []
+    for line_no, raw in enumerate(rows, start=1):
+        cells = [_import_cell(v) for v in raw[:4]]
+        if not any(cells):
+            continue
+        if line_no == 1 and cells[0].lower() == "дата":
+            continue
+        if len(items) + len(errors) >= IMPORT_MAX_ROWS:
+            errors.append(f"Строк больше {IMPORT_MAX_ROWS}, разбейте файл на части.")
+            break
+        cells += [""] * (4 - len(cells))
+        date, shift, product, qty = cells
+        try:
+            datetime.strptime(date, "%d.%m.%Y")
+        except ValueError:
+            errors.append(f"Строка {line_no}: неверная дата «{date}»")
+            continue
+        shift = shift.capitalize()
+        if shift not in ("День", "Ночь"):
+            errors.append(f"Строка {line_no}: смена должна быть День или Ночь")
+            continue
+        canonical = by_name.get(product.lower())
+        if not canonical:
+            errors.append(f"Строка {line_no}: продукция «{product}» не найдена в справочнике")
+            continue
+        qty = qty.replace(",", ".")
+        if not qty.replace(".", "", 1).isdigit():
+            errors.append(f"Строка {line_no}: неверное количество «{qty}»")
+            continue
+        items.append({"date": date, "shift": shift, "product": canonical, "quantity": qty})
+    return items, errors
+
+
+def load_import_document(document: dict, catalog: List[str]) -> Tuple[List[Dict[str, str]], List[str]]:
+    name = (document.get("file_name") or "").lower()
+    if name.endswith(".csv"):
+        parser = iter_csv_rows
+    elif name.endswith(".xlsx"):
+        parser = iter_xlsx_rows
+    else:
+        return [], ["Поддерживаются только файлы .csv и .xlsx"]
+    if int(document.get("file_size") or 0) > IMPORT_MAX_BYTES:
+        return [], ["Файл слишком большой."]
+    resp = tg_download_file(document["file_id"], IMPORT_MAX_BYTES)
+    try:
+        return parse_import_rows(parser(resp), catalog)
+    finally:
+        resp.close()
+
+
+def format_import_summary(items: List[Dict[str, str]]) -> str:
+    groups: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+    for it in items:
+        groups.setdefault((it["date"], it["shift"]), []).append(it)
+    lines = []
+    for n, ((date, shift), group) in enumerate(groups.items()):
+        if n >= 10:
+            lines.append(f"\n… и ещё групп: {len(groups) - 10}")
+            break
+        lines.append(f"\n<b>{date} | {shift}</b> — позиций: {len(group)}")
+        for it in group[:5]:
+            lines.append(f"• {it['product']} — {it['quantity']}")
+        if len(group) > 5:
+            lines.append(f"… и ещё {len(group) - 5}")
+    return "\n".join(lines)
+
+
+# ========== Export (CSV/XLSX) ==========
+EXPORT_PAGE_ROWS = 2000
+# requests собирает multipart-тело целиком в памяти, поэтому размер файла ограничен
+# (у sendDocument свой предел — 50 МБ)
+EXPORT_MAX_BYTES = 20 * 1024 * 1024
+_EXPORTS_RUNNING: set = set()
+_EXPORTS_LOCK = threading.Lock()
+
+
+def parse_export_args(text: str) -> Dict[str, str]:
+    """
+    Разбирает команду вида
+    /export лист=rf формат=xlsx месяц=10.2026 продукция=Бак 100 оператор=Иванов
+    Значения могут содержать пробелы — каждое продолжается до следующего "ключ=".
+    """
+    body = text[len("/export"):].strip()
+    args: Dict[str, str] = {}
+    for part in re.split(r"\s+(?=\w+=)", body):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            args[k.strip().lower()] = v.strip()
+    return args
+
+
+def filter_export_rows(rows: Iterable[List[str]], month: str = "", product: str = "", operator: str = "") -> Iterator[List[str]]:
+    """Отбирает неотменённые строки по месяцу (мм.гггг), продукции и подстроке в поле Пользователь."""
+    product = product.lower()
+    operator = operator.lower()
+    for row in rows:
+        if not any(row):
+            continue
+        row = row + [""] * (len(PROD_HEADERS) - len(row))
+        if row[6].strip().upper() == "ОТМЕНЕНО":
+            continue
+        if month and not row[0].endswith("." + month):
+            continue
+        if product and row[2].strip().lower() != product:
+            continue
+        if operator and operator not in row[4].lower():
+            continue
+        yield row
+
+
+def write_export_csv(rows: Iterable[List[str]], out) -> int:
+    wrapper = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+    writer = csv.writer(wrapper, delimiter=";")
+    writer.writerow(PROD_HEADERS)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+    wrapper.flush()
+    wrapper.detach()
+    return n
+
+
+def write_export_xlsx(rows: Iterable[List[str]], out) -> int:
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Выгрузка")
+    ws.append(PROD_HEADERS)
+    n = 0
+    for row in rows:
+        ws.append(row)
+        n += 1
+    wb.save(out)
+    return n
+
+
+def tg_send_document(chat_id: int, filename: str, fileobj, caption: str = ""):
+    try:
+        tg_call("sendDocument", data={"chat_id": chat_id, "caption": caption, "parse_mode": "HTML"},
+                files={"document": (filename, fileobj)}, timeout=120)
+    except Exception as e:
+        log.exception("tg_send_document error: %s", e)
+
+
+def run_export(sc: SheetClient, uid: int, chat: int, sheet_title: str, args: Dict[str, str]):
+    """Формирует выгрузку в фоне: постраничное чтение -> фильтр -> запись во временный файл -> sendDocument."""
+    fmt = "xlsx" if args.get("формат", "csv").lower() == "xlsx" else "csv"
+    try:
+        rows = filter_export_rows(sc.iter_rows(sheet_title, EXPORT_PAGE_ROWS),
+                                 month=args.get("месяц", ""),
+                                 product=args.get("продукция", ""),
+                                 operator=args.get("оператор", ""))
+        with tempfile.TemporaryFile() as tmp:
+            n = write_export_xlsx(rows, tmp) if fmt == "xlsx" else write_export_csv(rows, tmp)
+            if not n:
+                tg_send(chat, "Нет строк, подходящих под условия выгрузки.")
+                return
+            if tmp.tell() > EXPORT_MAX_BYTES:
+                tg_send(chat, f"Выгрузка больше {EXPORT_MAX_BYTES // (1024 * 1024)} МБ — сузьте условия "
+                              "(месяц, продукция, оператор).")
+                return
+            tmp.seek(0)
+            filename = f"export_{'rf' if sheet_title == RF_SHEET else 'ppi'}_{now_msk().strftime('%Y%m%d_%H%M')}.{fmt}"
+            tg_send_document(chat, filename, tmp, f"{sheet_title}: строк {n}")
+    except Exception:
+        log.exception("export failed for %s", uid)
+        tg_send(chat, "Не удалось сформировать выгрузку.")
+    finally:
+        with _EXPORTS_LOCK:
+            _EXPORTS_RUNNING.discard(uid)
+
+
+def start_export(sc: SheetClient, uid: int, chat: int, sheet_title: str, args: Dict[str, str]) -> bool:
+    """Запускает выгрузку в отдельном потоке; не более одной выгрузки на пользователя."""
+    with _EXPORTS_LOCK:
+        if uid in _EXPORTS_RUNNING:
+            return False
+        _EXPORTS_RUNNING.add(uid)
+    threading.Thread(target=run_export, args=(sc, uid, chat, sheet_title, args), daemon=True).start()
+    return True
+
+
+# ========== Durable outbox (SQLite) ==========
+class Outbox:
+    """
+    Персистентная очередь исходящих операций: уведомления Telegram ("tg_message")
+    и записи в таблицу, которые не удалось выполнить сразу ("sheets_append").
+    Несколько процессов делят один файл: запись забирается через claimed_by (свой токен
+    на каждую пачку), брошенные (процесс умер) забираются снова через CLAIM_TIMEOUT секунд.
+    Записи в таблицу не выбрасываются: после MAX_ATTEMPTS пользователь и контролёры
+    получают предупреждение, а повторы продолжаются.
+    """
+
+    CLAIM_TIMEOUT = 60
+    MAX_ATTEMPTS = 20
+    BATCH = 20
+
+    def __init__(self, path: str):
+        self.path = path
+        self.owner = f"{os.getpid()}-{int(time.time() * 1000)}"
+        self.accepting = True
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, created_at REAL NOT NULL,"
+            " claimed_by TEXT, claimed_at REAL)")
+
+    def enqueue(self, kind: str, payload: Dict[str, Any]):
+        now_ts = time.time()
+        with self._lock:
+            self._conn.execute("INSERT INTO outbox (kind, payload, next_at, created_at) VALUES (?, ?, ?, ?)",
+                               (kind, json.dumps(payload, ensure_ascii=False), now_ts, now_ts))
+        self._wake.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _claim(self, token: str) -> List[Tuple[int, str, str, int]]:
+        now_ts = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+                " SELECT id FROM outbox WHERE next_at <= ? AND (claimed_by IS NULL OR claimed_at < ?)"
+                " ORDER BY id LIMIT ?)",
+                (token, now_ts, now_ts, now_ts - self.CLAIM_TIMEOUT, self.BATCH))
+            return self._conn.execute(
+                "SELECT id, kind, payload, attempts FROM outbox WHERE claimed_by = ? ORDER BY id",
+                (token,)).fetchall()
+
+    def _release(self, token: str):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?", (token,))
+
+    def _done(self, item_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+    def _retry(self, item_id: int, attempts: int, delay: float):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET attempts = ?, next_at = ?, claimed_by = NULL, claimed_at = NULL "
+                               "WHERE id = ?", (attempts, time.time() + delay, item_id))
+
+    def _deliver(self, kind: str, payload: Dict[str, Any]) -> Tuple[bool, float]:
+        """Возвращает (готово, задержка до повтора). Готово=True и при безнадёжной ошибке."""
+        if kind == "tg_message":
+            body = {"chat_id": payload["chat_id"], "text": payload["text"], "parse_mode": "HTML"}
+            if payload.get("markup"):
+                body["reply_markup"] = json.dumps(payload["markup"], ensure_ascii=False)
+            r = tg_call("sendMessage", json=body)
+            if r.status_code == 429:
+                return False, float((r.json().get("parameters") or {}).get("retry_after", 5))
+            if r.status_code in (400, 403):
+                # чат не найден / бот заблокирован — повторять бессмысленно
+                log.warning("outbox: message to %s rejected: %s", payload["chat_id"], r.status_code)
+                return True, 0
+            return r.status_code < 300, 0
+        if kind == "sheets_append":
+            sc = sites.clients.get(payload["site"])
+            if sc is None:
+                log.error("outbox: unknown site %s, dropping write", payload["site"])
+                return True, 0
+            rows = payload["rows"]
+            session_id = rows[0][7] if len(rows[0]) > 7 else ""
+            # прошлая попытка могла записать строки, а ответ потеряться — сначала ищем сессию в листе
+            written = sc.find_written_session(payload["sheet"], session_id) if session_id else None
+            if written:
+                log.info("outbox: session %s already in %s, not appending again", session_id, payload["sheet"])
+            else:
+                written = sc.append_records(payload["sheet"], rows)
+            if written and payload.get("uid"):
+                session_index.add(sc.spreadsheet_id, payload["sheet"], payload["uid"], payload["rows"], written)
+            return written is not None, 0
+        log.error("outbox: unknown kind %s", kind)
+        return True, 0
+
+    def _alert_stuck_write(self, payload: Dict[str, Any], attempts: int):
+        """Запись в таблицу не проходит долго — предупреждаем автора и контролёров, повторы продолжаются."""
+        sc = sites.clients[payload["site"]]
+        text = (f"⚠️ <b>Запись не удаётся сохранить</b> в {payload['sheet']} ({attempts} попыток).\n"
+                f"Позиций: {len(payload['rows'])}, продолжаю повторять.")
+        ctrl_sheet = CTRL_RF_SHEET if payload["sheet"] == RF_SHEET else CTRL_PPI_SHEET
+        recipients = set(get_controllers_cached(sc, ctrl_sheet))
+        if payload.get("uid"):
+            recipients.add(payload["uid"])
+        for chat_id in recipients:
+            self.enqueue("tg_message", {"chat_id": chat_id, "text": text})
+
+    def process(self, until: Optional[float] = None) -> int:
+        """
+        Обрабатывает одну пачку готовых записей (до момента until); возвращает число обработанных.
+        Необработанные записи пачки сразу отпускаются.
+        """
+        token = f"{self.owner}-{secrets.token_hex(4)}"
+        items = self._claim(token)
+        handled = 0
+        try:
+            for item_id, kind, payload, attempts in items:
+                if until is not None and time.time() >= until:
+                    break
+                payload = json.loads(payload)
+                try:
+                    ok, delay = self._deliver(kind, payload)
+                except Exception:
+                    log.exception("outbox: %s delivery failed", kind)
+                    ok, delay = False, 0
+                handled += 1
+                if ok:
+                    self._done(item_id)
+                    continue
+                if attempts + 1 >= self.MAX_ATTEMPTS and kind != "sheets_append":
+                    log.error("outbox: giving up on %s #%s after %s attempts", kind, item_id, attempts + 1)
+                    self._done(item_id)
+                    continue
+                if attempts + 1 == self.MAX_ATTEMPTS:
+                    log.error("outbox: %s #%s still failing after %s attempts", kind, item_id, attempts + 1)
+                    self._alert_stuck_write(payload, attempts + 1)
+                self._retry(item_id, attempts + 1, delay or min(2 ** attempts, 300))
+        finally:
+            self._release(token)
+        return handled
+
+    def start(self):
+        self._thread = threading.Thread(target=self.worker, daemon=True)
+        self._thread.start()
+
+    def worker(self):
+        while not self._stop.is_set():
+            self._wake.wait(timeout=1)
+            self._wake.clear()
+            try:
+                while not self._stop.is_set() and self.process():
+                    pass
+            except Exception:
+                log.exception("outbox worker error")
+
+    def drain(self, deadline: float) -> int:
+        """
+        Прекращает приём работы, останавливает фоновый worker и дожидается отправки очереди;
+        возвращает число оставшихся записей.
+        """
+        self.accepting = False
+        until = time.time() + deadline
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=deadline)
+        while time.time() < until:
+            if not self.process(until):
+                with self._lock:
+                    due = self._conn.execute("SELECT MIN(next_at) FROM outbox").fetchone()[0]
+                if due is None or due > until:
+                    break
+                time.sleep(min(0.5, max(0.0, due - time.time())))
+        return self.pending()
+
+
+outbox = Outbox(OUTBOX_PATH)
+
+
+# ========== Session index (O(1) cancel) ==========
+SESSIONS_PER_USER = 20
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(6)
+
+
+class SessionIndex:
+    """
+    Локальный индекс сохранённых сессий: (таблица, лист, пользователь) -> последние сессии
+    с номерами строк и их содержимым. Отмена берёт последнюю сессию отсюда, не читая лист.
+    Если сессию проиндексировать нельзя, записи пользователя сбрасываются — иначе "последней"
+    оказалась бы более старая сессия; отмена тогда идёт поиском по листу.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, spreadsheet TEXT NOT NULL, sheet TEXT NOT NULL,"
+            " uid INTEGER NOT NULL, session_id TEXT NOT NULL, first_row INTEGER NOT NULL,"
+            " last_row INTEGER NOT NULL, rows TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_user ON sessions (spreadsheet, sheet, uid, id)")
+
+    def add(self, spreadsheet: str, sheet: str, uid: int, rows: List[List[Any]], written: Tuple[int, int]) -> bool:
+        first, last = written
+        if not first or last - first + 1 != len(rows):
+            log.warning("session index: unexpected rows %s for %s rows, dropping index of %s", written, len(rows), uid)
+            self.drop_user(spreadsheet, sheet, uid)
+            return False
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (spreadsheet, sheet, uid, session_id, first_row, last_row, rows)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (spreadsheet, sheet, uid, rows[0][7], first, last, json.dumps(rows, ensure_ascii=False)))
+            self._conn.execute(
+                "DELETE FROM sessions WHERE spreadsheet = ? AND sheet = ? AND uid = ? AND id NOT IN ("
+                " SELECT id FROM sessions WHERE spreadsheet = ? AND sheet = ? AND uid = ? ORDER BY id DESC LIMIT ?)",
+                (spreadsheet, sheet, uid, spreadsheet, sheet, uid, SESSIONS_PER_USER))
+        return True
+
+    def drop_user(self, spreadsheet: str, sheet: str, uid: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE spreadsheet = ? AND sheet = ? AND uid = ?",
+                               (spreadsheet, sheet, uid))
+
+    def last(self, spreadsheet: str, sheet: str, uid: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT session_id, first_row, last_row, rows FROM sessions"
+                " WHERE spreadsheet = ? AND sheet = ? AND uid = ? ORDER BY id DESC LIMIT 1",
+                (spreadsheet, sheet, uid)).fetchone()
+        if not row:
+            return None
+        return {"session_id": row[0], "first_row": row[1], "last_row": row[2], "rows": json.loads(row[3])}
+
+    def remove(self, spreadsheet: str, sheet: str, uid: int, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE spreadsheet = ? AND sheet = ? AND uid = ? AND session_id = ?",
+                               (spreadsheet, sheet, uid, session_id))
+
+
+session_index = SessionIndex(SESSION_INDEX_PATH)
+
+
+def tg_send_durable(chat_id: int, text: str, markup: Optional[dict] = None):
+    """Уведомление, которое не должно потеряться при рестарте: уходит через outbox."""
+    outbox.enqueue("tg_message", {"chat_id": chat_id, "text": text, "markup": markup})
+
+
 # ========== AuthManager ==========
+APPROVED_REFRESH = 60  # период обновления множества подтверждённых пользователей, сек
+
+
 class AuthManager:
-    def __init__(self, sc: SheetClient):
-        self.sc = sc
+    """Пользователи хранятся в листе "Пользователи" таблицы своей площадки."""
+
+    def __init__(self, router: SiteRouter):
+        self.sites = router
+        # площадка -> id подтверждённых пользователей; для горячего пути (inline) без чтения таблицы
+        self.approved: Dict[str, set] = {}
 
     def get_user(self, uid: int) -> Optional[Dict[str, str]]:
-        return self.sc.find_user(uid)
+        return self.sites.for_user(uid).find_user(uid)
+
+    def is_approved(self, uid: int) -> bool:
+        return str(uid) in self.approved.get(self.sites.for_user(uid).site, ())
+
+    def refresh_approved(self):
+        for site, sc in self.sites.clients.items():
+            rows = sc.get_users_rows()
+            if not rows:
+                continue  # ошибка чтения — оставляем прежнее множество
+            self.approved[site] = {row[0] for row in rows[1:]
+                                   if row and len(row) > 3 and row[3].strip() == "подтвержден"}
+
+    def _set_approved(self, uid: int, approved: bool):
+        uids = self.approved.setdefault(self.sites.for_user(uid).site, set())
+        if approved:
+            uids.add(str(uid))
+        else:
+            uids.discard(str(uid))
 
     def register_user(self, uid: int, fio: str, requested_by: str = ""):
-        self.sc.add_user(uid, fio, requested_by)
+        self.sites.for_user(uid).add_user(uid, fio, requested_by)
         self.notify_approvers_new_user(uid, fio)
 
     def notify_approvers_new_user(self, uid: int, fio: str):
-        approvers = self.sc.get_approvers()
+        approvers = self.sites.for_user(uid).get_approvers()
         if not approvers:
             log.info("No approvers to notify for new user %s", uid)
             return
@@ -370,12 +1767,7 @@ class AuthManager:
         }
         text = f"<b>Новая заявка на доступ</b>\nФИО: {fio}\nID: <code>{uid}</code>"
         for a in approvers:
-            try:
-                requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-                              json={"chat_id": a, "text": text, "parse_mode": "HTML", "reply_markup": json.dumps(kb, ensure_ascii=False)},
-                              timeout=10)
-            except Exception:
-                log.exception("notify approver failed for %s", a)
+            tg_send_durable(a, text, kb)
 
     def process_callback(self, callback: dict):
         data = callback.get("data", "")
@@ -398,7 +1790,8 @@ class AuthManager:
                 kb = {"inline_keyboard": [[{"text": r, "callback_data": f"setrole_{target_id}_{r}"}] for r in roles]}
                 tg_send(chat_id, f"Выберите роль для <b>{target['fio']}</b>:", kb)
             else:
-                self.sc.update_user(target_id, status="отклонен", confirmed_by=uid)
+                self.sites.for_user(target_id).update_user(target_id, status="отклонен", confirmed_by=uid)
+                self._set_approved(target_id, False)
                 tg_send(chat_id, f"Заявка отклонена: {target['fio']}")
                 try:
                     tg_send(int(target_id), "В доступе отказано.")
@@ -417,7 +1810,8 @@ class AuthManager:
             if approver["role"] == "master" and role == "admin":
                 tg_send(chat_id, "Мастер не может назначать роль admin.")
                 return
-            self.sc.update_user(target_id, role=role, status="подтвержден", confirmed_by=uid)
+            self.sites.for_user(target_id).update_user(target_id, role=role, status="подтвержден", confirmed_by=uid)
+            self._set_approved(target_id, True)
             target = self.get_user(target_id)
             tg_send(chat_id, f"Пользователь {target['fio']} подтверждён как <b>{role}</b>")
             try:
@@ -426,12 +1820,12 @@ class AuthManager:
                 pass
 
 
-auth = AuthManager(sheet_client)
+auth = AuthManager(sites)
 
 # ========== FSM: управление состояниями и диалогами ==========
 class FSM:
-    def __init__(self, sc: SheetClient, authm: AuthManager):
-        self.sc = sc
+    def __init__(self, router: SiteRouter, authm: AuthManager):
+        self.sites = router
         self.auth = authm
         self.states: Dict[int, dict] = {}
         self.last_activity: Dict[int, float] = {}
@@ -447,7 +1841,7 @@ class FSM:
                     st = self.states.pop(uid, None)
                     if st:
                         try:
-                            tg_send(st.get("chat"), "Диалог прерван — неактивность 10 минут.")
+                            tg_send_durable(st.get("chat"), "Диалог прерван — неактивность 10 минут.")
                         except Exception:
                             pass
                     self.last_activity.pop(uid, None)
@@ -469,6 +1863,7 @@ class FSM:
         self.touch(uid)
         self.ensure_state(uid, chat)
         st = self.states[uid]
+        set_log_context(flow=st.get("flow"), step=st.get("step"))
 
         # navigation & cancel
         if text == "Назад":
@@ -502,6 +1897,11 @@ class FSM:
             tg_send(chat, "Ваш доступ пока не подтверждён администратором.")
             return
 
+        # export
+        if text.startswith("/export"):
+            self._handle_export(uid, chat, user, st, text)
+            return
+
         # flow selection
         if "flow" not in st:
             if text in ("/start", "Ротационное формование"):
@@ -516,6 +1916,7 @@ class FSM:
             return
 
         flow = st["flow"]
+        sc = self.sites.for_user(uid, flow)
 
         # cancel last record
         if text == "Отменить последнюю запись":
@@ -524,13 +1925,21 @@ class FSM:
                 return
 
             sheet = RF_SHEET if flow == "rf" else PPI_SHEET
-            session_rows = self.sc.find_last_session_records(sheet, uid)
+            last = session_index.last(sc.spreadsheet_id, sheet, uid)
+            if last:
+                session_rows = [(r, last["first_row"] + i) for i, r in enumerate(last["rows"])]
+                session_id = last["session_id"]
+            else:
+                # индекса нет (новый диск) или он сброшен — поиск по листу
+                session_rows = sc.find_last_session_records(sheet, uid)
+                last_cells = session_rows[-1][0] if session_rows else []
+                session_id = last_cells[7] if len(last_cells) > 7 and last_cells[7] else None
             if not session_rows:
                 tg_send(chat, "У вас нет активных записей для отмены.", FLOW_MENU_KB)
                 return
 
             # сохраняем все строки сессии в pending_cancel
-            st["pending_cancel"] = {"ws": sheet, "rows": session_rows}
+            st["pending_cancel"] = {"ws": sheet, "rows": session_rows, "session_id": session_id}
 
             # соберем превью сессии для подтверждения
             first_row = session_rows[0][0]
@@ -547,19 +1956,74 @@ class FSM:
             return
 
 
+        # bulk import from file
+        if text == "Импорт из файла":
+            st.pop("pending_import", None)
+            st["step"] = "import_wait_file"
+            tg_send(chat,
+                    "Отправьте файл <b>.csv</b> или <b>.xlsx</b> со столбцами:\n"
+                    "Дата (дд.мм.гггг) | Смена (День/Ночь) | Продукция | Количество\n\n"
+                    "Строка заголовка необязательна.", CANCEL_KB)
+            return
+
+        if "pending_import" in st:
+            if text == "Да, импортировать":
+                pend = st.pop("pending_import")
+                self._save_import(self.sites.clients[pend["site"]], uid, chat, user, pend["ws"], pend["items"])
+                return
+            tg_send(chat, "Подтвердите импорт или нажмите Отмена.", IMPORT_CONFIRM_KB)
+            return
+
         # confirm cancel
         if "pending_cancel" in st:
             if text == "Да, отменить":
                 pend = st["pending_cancel"]
                 ws_title = pend["ws"]
                 rows = pend["rows"]  # список (row, rownum)
-
-                # пометим каждую строку статусом ОТМЕНЕНО (столбец G)
-                for (_, rownum) in rows:
-                    try:
-                        self.sc.update_cell(ws_title, f"G{rownum}", "ОТМЕНЕНО")
-                    except Exception:
-                        log.exception("Failed to mark canceled row %s in %s", rownum, ws_title)
+                session_id = pend.get("session_id")
+                rownums = [rownum for (_, rownum) in rows]
+
+                if session_id:
+                    # читаем E:H от начала сессии до конца листа: сверяем id сессии (H) и
+                    # проверяем, что после неё нет более новых записей пользователя (индекс мог отстать)
+                    tail = sc.get_range(ws_title, f"E{rownums[0]}:H")
+                    newer = tail[len(rownums):] if tail is not None else None
+                    if tail is not None and (len(tail) < len(rownums) or
+                                             any(len(r) < 4 or r[3] != session_id for r in tail[:len(rownums)])):
+                        # строки сдвинули — ищем по id во всём листе
+                        found = sc.find_session_rows(ws_title, session_id)
+                        if found is None:
+                            newer = None
+                        else:
+                            rownums, vals = found
+                            newer = [r[4:8] for r in vals[rownums[-1]:]] if rownums else []
+                    if newer is None:
+                        # ошибка чтения — индекс не трогаем, отмену можно повторить
+                        st.pop("pending_cancel", None)
+                        tg_send(chat, "Не удалось отменить запись: таблица недоступна. Попробуйте позже.", FLOW_MENU_KB)
+                        return
+                    if not rownums:
+                        # лист прочитан, строк с этим id нет — запись в индексе больше не нужна
+                        session_index.remove(sc.spreadsheet_id, ws_title, uid, session_id)
+                        st.pop("pending_cancel", None)
+                        tg_send(chat, "Строки этой сессии не найдены в таблице.", FLOW_MENU_KB)
+                        return
+                    if any(r and f"({uid})" in r[0] and (r[2] if len(r) > 2 else "").strip() != "ОТМЕНЕНО"
+                           for r in newer):
+                        session_index.drop_user(sc.spreadsheet_id, ws_title, uid)
+                        st.pop("pending_cancel", None)
+                        tg_send(chat, "После этой сессии есть более новые записи. "
+                                      "Нажмите «Отменить последнюю запись» ещё раз.", FLOW_MENU_KB)
+                        return
+
+                # пометим все строки сессии статусом ОТМЕНЕНО (столбец G) одним запросом
+                if not rownums or not sc.mark_rows_canceled(ws_title, rownums):
+                    log.error("Failed to mark canceled rows %s in %s", rownums, ws_title)
+                    st.pop("pending_cancel", None)
+                    tg_send(chat, "Не удалось отменить запись: таблица недоступна. Попробуйте позже.", FLOW_MENU_KB)
+                    return
+                if session_id:
+                    session_index.remove(sc.spreadsheet_id, ws_title, uid, session_id)
 
                 # подготовим сообщение пользователю
                 first_row = rows[0][0] if rows else None
@@ -594,9 +2058,9 @@ class FSM:
 
                 ctrl_msg += f"\nОтменил: {user['fio']}"
 
-                for cid in get_controllers_cached(ctrl_sheet):
+                for cid in get_controllers_cached(sc, ctrl_sheet):
                     try:
-                        tg_send(cid, ctrl_msg)
+                        tg_send_durable(cid, ctrl_msg)
                     except Exception:
                         pass
 
@@ -615,7 +2079,7 @@ class FSM:
             st["cancel_used"] = False
             # show recent records
             sheet = RF_SHEET if flow == "rf" else PPI_SHEET
-            recent = self.sc.get_last_records(sheet, 5)
+            recent = sc.get_last_records(sheet, 5)
             msg = f"<b>Последние записи ({sheet}):</b>\n\n"
             if recent:
                 # show up to 5
@@ -681,12 +2145,12 @@ class FSM:
             data["shift"] = text
             # ask product from appropriate sheet
             prod_list_sheet = "Продукция РФ" if flow == "rf" else "Продукция ППИ"
-            prod_kb = build_product_kb(prod_list_sheet, extra=["Другая продукция"])
+            prod_kb = build_product_kb(sc, prod_list_sheet, extra=["Другая продукция"], uid=uid)
             st["step"] = "product"
             st["data"] = data
             # initialize product list holder
             st["products_list"] = []
-            tg_send(chat, "Выберите продукцию (или 'Другая продукция'):", prod_kb)
+            tg_send(chat, "Выберите продукцию (или 'Другая продукция'):" + product_search_hint(sc, prod_list_sheet), prod_kb)
             return
 
         # === MULTI-PRODUCT CYCLE ===
@@ -740,6 +2204,7 @@ class FSM:
 
             # reset product field for next iteration
             data.pop("product", None)
+            record_recent_product(uid, product_name)
 
             # Ask whether to continue cycle
             st["step"] = "add_more"
@@ -753,9 +2218,9 @@ class FSM:
             if text == "Да, добавить":
                 # go back to product selection
                 prod_list_sheet = "Продукция РФ" if flow == "rf" else "Продукция ППИ"
-                prod_kb = build_product_kb(prod_list_sheet, extra=["Другая продукция"])
+                prod_kb = build_product_kb(sc, prod_list_sheet, extra=["Другая продукция"], uid=uid)
                 st["step"] = "product"
-                tg_send(chat, "Выберите продукцию:", prod_kb)
+                tg_send(chat, "Выберите продукцию:" + product_search_hint(sc, prod_list_sheet), prod_kb)
                 return
 
             if text == "Нет, завершить":
@@ -771,24 +2236,30 @@ class FSM:
                 # Common fields
                 user_field = f"{user['fio']} ({uid})"
                 ts = now_msk_str()
+                session_id = new_session_id()
 
-                for item in plist:
-                    row = [
+                rows = [
+                    [
                         data.get("date", ""),
                         data.get("shift", ""),
                         item.get("product", ""),
                         item.get("quantity", ""),
                         user_field,
                         ts,
-                        ""
+                        "",
+                        session_id
                     ]
-                    try:
-                        self.sc.append_record(target_sheet, row)
-                    except Exception:
-                        log.exception("append multiple failed")
+                    for item in plist
+                ]
+                saved = sc.append_records(target_sheet, rows)
+                if saved:
+                    session_index.add(sc.spreadsheet_id, target_sheet, uid, rows, saved)
+                else:
+                    # не теряем запись: повторим из outbox
+                    outbox.enqueue("sheets_append", {"site": sc.site, "sheet": target_sheet, "rows": rows, "uid": uid})
 
                 # confirmation
-                msg = "✅ <b>Запись сохранена</b>\n\n"
+                msg = "✅ <b>Запись сохранена</b>\n\n" if saved else "⏳ <b>Запись принята</b>, таблица недоступна — сохраню автоматически.\n\n"
                 msg += f"{target_sheet}\n"
                 msg += f"Дата: <b>{data.get('date','')}</b>\n"
                 msg += f"Смена: <b>{data.get('shift','')}</b>\n\n"
@@ -809,9 +2280,9 @@ class FSM:
                     + "\n".join([f"• {i['product']} — {i['quantity']}" for i in plist])
                 )
 
-                for cid in get_controllers_cached(ctrl_sheet):
+                for cid in get_controllers_cached(sc, ctrl_sheet):
                     try:
-                        tg_send(cid, notify)
+                        tg_send_durable(cid, notify)
                     except Exception:
                         pass
 
@@ -827,9 +2298,124 @@ class FSM:
             tg_send(chat, "Нажмите Да или Завершить.", kb_reply([["Да"], ["Завершить"], ["Отмена"]]))
             return
 
+        if step == "import_wait_file":
+            tg_send(chat, "Отправьте файл .csv или .xlsx документом или нажмите Отмена.", CANCEL_KB)
+            return
+
+        if step == "import_parsing":
+            tg_send(chat, "Файл ещё проверяется, подождите или нажмите Отмена.", CANCEL_KB)
+            return
+
         # fallback
         tg_send(chat, "Выберите действие:", FLOW_MENU_KB)
 
+    def _handle_export(self, uid: int, chat: int, user: Dict[str, str], st: dict, text: str):
+        args = parse_export_args(text)
+        flow = args.get("лист", st.get("flow", "")).lower()
+        if flow not in ("rf", "ppi"):
+            tg_send(chat,
+                    "Использование:\n<code>/export лист=rf|ppi формат=csv|xlsx месяц=мм.гггг "
+                    "продукция=... оператор=...</code>\nВсе параметры, кроме листа, необязательны; "
+                    "лист можно не указывать внутри выбранного производства.")
+            return
+        sc = self.sites.for_user(uid, flow)
+        sheet = RF_SHEET if flow == "rf" else PPI_SHEET
+        ctrl_sheet = CTRL_RF_SHEET if flow == "rf" else CTRL_PPI_SHEET
+        if user["role"] not in ("admin", "master") and uid not in get_controllers_cached(sc, ctrl_sheet):
+            tg_send(chat, "У вас нет прав на выгрузку.")
+            return
+        if not start_export(sc, uid, chat, sheet, args):
+            tg_send(chat, "Предыдущая выгрузка ещё формируется.")
+            return
+        tg_send(chat, f"Формирую выгрузку ({sheet}), файл придёт отдельным сообщением.")
+
+    def handle_document(self, uid: int, chat: int, document: dict, user_repr: str):
+        """
+        Вызывается под FileLock: только проверка состояния и запуск фонового разбора файла.
+        Загрузка, справочник и парсинг выполняются в _import_worker без удержания лока.
+        """
+        self.touch(uid)
+        self.ensure_state(uid, chat)
+        st = self.states[uid]
+
+        user = self.auth.get_user(uid)
+        if user is None or user["status"] != "подтвержден":
+            tg_send(chat, "Ваш доступ пока не подтверждён администратором.")
+            return
+        if st.get("step") != "import_wait_file" or "flow" not in st:
+            tg_send(chat, "Чтобы загрузить файл, выберите производство и нажмите «Импорт из файла».")
+            return
+
+        flow = st["flow"]
+        token = new_session_id()
+        st["step"] = "import_parsing"
+        st["import_token"] = token
+        threading.Thread(target=self._import_worker, args=(uid, chat, flow, document, token), daemon=True).start()
+        tg_send(chat, "Файл получен, проверяю…")
+
+    def _import_worker(self, uid: int, chat: int, flow: str, document: dict, token: str):
+        sc = self.sites.for_user(uid, flow)
+        target_sheet = RF_SHEET if flow == "rf" else PPI_SHEET
+        try:
+            catalog = load_product_catalog(sc, "Продукция РФ" if flow == "rf" else "Продукция ППИ")
+            items, errors = load_import_document(document, catalog)
+        except Exception:
+            log.exception("import download/parse failed for %s", uid)
+            items, errors = [], ["Не удалось прочитать файл."]
+
+        with FileLock(LOCK_PATH):
+            st = self.states.get(uid)
+            if not st or st.get("import_token") != token:
+                # пользователь отменил диалог или загрузил другой файл
+                return
+            st.pop("import_token", None)
+            if errors:
+                st["step"] = "import_wait_file"
+                msg = f"❌ <b>Файл не импортирован</b>, ошибок: {len(errors)}\n\n"
+                msg += "\n".join(errors[:IMPORT_MAX_ERRORS_SHOWN])
+                if len(errors) > IMPORT_MAX_ERRORS_SHOWN:
+                    msg += f"\n… и ещё {len(errors) - IMPORT_MAX_ERRORS_SHOWN}"
+                tg_send(chat, msg + "\n\nИсправьте файл и отправьте снова.", CANCEL_KB)
+                return
+            if not items:
+                st["step"] = "import_wait_file"
+                tg_send(chat, "В файле нет строк для импорта.", CANCEL_KB)
+                return
+
+            st.pop("step", None)
+            st["pending_import"] = {"site": sc.site, "ws": target_sheet, "items": items}
+            msg = f"<b>Импорт в {target_sheet}</b>\nВсего позиций: {len(items)}\n" + format_import_summary(items)
+            msg += "\n\nИмпортировать?"
+            tg_send(chat, msg, IMPORT_CONFIRM_KB)
+
+    def _save_import(self, sc: SheetClient, uid: int, chat: int, user: Dict[str, str], target_sheet: str, items: List[Dict[str, str]]):
+        user_field = f"{user['fio']} ({uid})"
+        ts = now_msk_str()
+        session_id = new_session_id()
+        rows = [[it["date"], it["shift"], it["product"], it["quantity"], user_field, ts, "", session_id] for it in items]
+        saved = sc.append_records(target_sheet, rows)
+        if saved:
+            session_index.add(sc.spreadsheet_id, target_sheet, uid, rows, saved)
+        else:
+            outbox.enqueue("sheets_append", {"site": sc.site, "sheet": target_sheet, "rows": rows, "uid": uid})
+
+        summary = format_import_summary(items)
+        head = "✅ <b>Импорт выполнен</b>" if saved else "⏳ <b>Импорт принят</b>, таблица недоступна — сохраню автоматически."
+        tg_send(chat, f"{head}\n\n{target_sheet}\nПозиций: {len(items)}\n{summary}", FLOW_MENU_KB)
+
+        ctrl_sheet = CTRL_RF_SHEET if target_sheet == RF_SHEET else CTRL_PPI_SHEET
+        notify = (
+            f"⚠️ <b>ИМПОРТ ЗАПИСЕЙ ({target_sheet})</b>\n"
+            f"Добавил: {user['fio']}\n"
+            f"Позиций: {len(items)}\n"
+            + summary
+        )
+        for cid in get_controllers_cached(sc, ctrl_sheet):
+            try:
+                tg_send_durable(cid, notify)
+            except Exception:
+                pass
+
 
 # ========== Flask webhook & callbacks ==========
 app = Flask(__name__)
@@ -837,36 +2423,104 @@ LOCK_PATH = "/tmp/bot.lock"
 
 # start controllers refresher thread that warms cache once per day
 def controllers_refresher_worker(interval_min: int = 1440):
+    while True:
+        for sc in sites.clients.values():
+            try:
+                sc.invalidate_cache(CTRL_RF_SHEET)
+                sc.invalidate_cache(CTRL_PPI_SHEET)
+                _ = sc.get_controllers(CTRL_RF_SHEET)
+                _ = sc.get_controllers(CTRL_PPI_SHEET)
+                log.info("Controllers cache refreshed (%s)", sc.site)
+            except Exception:
+                log.exception("Error refreshing controllers cache (%s)", sc.site)
+        time.sleep(interval_min * 60)
+
+
+def approved_refresher_worker(interval: int = APPROVED_REFRESH, wait_for: Iterable[threading.Thread] = ()):
+    # права берём из перечитанного листа, а не из снапшота
+    for thread in wait_for:
+        thread.join(timeout=SNAPSHOT_GRACE)
     while True:
         try:
-            sheet_client.invalidate_cache(CTRL_RF_SHEET)
-            sheet_client.invalidate_cache(CTRL_PPI_SHEET)
-            _ = sheet_client.get_controllers(CTRL_RF_SHEET)
-            _ = sheet_client.get_controllers(CTRL_PPI_SHEET)
-            log.info("Controllers cache refreshed")
+            auth.refresh_approved()
         except Exception:
-            log.exception("Error refreshing controllers cache")
-        time.sleep(interval_min * 60)
+            log.exception("Error refreshing approved users")
+        time.sleep(interval)
 
 threading.Thread(target=controllers_refresher_worker, daemon=True).start()
+_revalidations = [t for t in (warm_start_from_snapshot(_sc) for _sc in sites.clients.values()) if t]
+threading.Thread(target=approved_refresher_worker, kwargs={"wait_for": _revalidations}, daemon=True).start()
+threading.Thread(target=snapshot_saver_worker, daemon=True).start()
+outbox.start()
+
+
+_sigterm_received = threading.Event()
+
+
+def _on_sigterm(signum, frame):
+    # в обработчике сигнала — только флаги: SQLite, логирование и ожидание здесь могут
+    # встать на блокировке, которую держит прерванный код. Прежний обработчик
+    # возвращаем сразу, его вызовет повторный сигнал после drain.
+    outbox.accepting = False
+    signal.signal(signal.SIGTERM, _prev_sigterm if _prev_sigterm is not None else signal.SIG_DFL)
+    _sigterm_received.set()
+
+
+def _drain_on_sigterm():
+    _sigterm_received.wait()
+    log.info("SIGTERM: draining outbox (%s pending)", outbox.pending())
+    left = outbox.drain(DRAIN_DEADLINE)
+    log.info("Drain finished, %s items left for next boot", left)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+try:
+    _prev_sigterm = signal.getsignal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    threading.Thread(target=_drain_on_sigterm, daemon=True).start()
+except ValueError:
+    # импорт не из главного потока — сигналы ставить нельзя, остаётся очередь в SQLite
+    _prev_sigterm = None
 
-fsm = FSM(sheet_client, auth)
+fsm = FSM(sites, auth)
+
+if WEBHOOK_AUTO_REGISTER and WEBHOOK_URL:
+    webhook_manager.ensure()
 
 @app.route("/", methods=["POST"])
 def webhook():
-    update = request.get_json()
+    # дешёвые проверки до разбора JSON: секрет из setWebhook и размер тела
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()):
+        return "forbidden", 403
+    if (request.content_length or 0) > MAX_UPDATE_BYTES:
+        return "too large", 413
+    if not outbox.accepting:
+        # идёт остановка — Telegram повторит доставку уже новому процессу
+        return "draining", 503
+    update = request.get_json(silent=True)
     if not update:
         return "ok", 200
 
     # handle callback_query (inline buttons for approvals)
     if "callback_query" in update:
-        try:
-            auth.process_callback(update["callback_query"])
-            # answer callback
-            requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery",
-                          json={"callback_query_id": update["callback_query"]["id"]})
-        except Exception:
-            log.exception("callback processing error")
+        with trace_update(update):
+            set_log_context(uid=update["callback_query"]["from"]["id"])
+            try:
+                auth.process_callback(update["callback_query"])
+                # answer callback
+                tg_call("answerCallbackQuery", json={"callback_query_id": update["callback_query"]["id"]})
+            except Exception:
+                log.exception("callback processing error")
+        return "ok", 200
+
+    # inline-поиск продукции: только чтение индекса, без FileLock
+    if "inline_query" in update:
+        with trace_update(update):
+            iq = update["inline_query"]
+            set_log_context(uid=iq["from"]["id"])
+            st = fsm.states.get(iq["from"]["id"], {})
+            answer_inline_query(iq, st.get("flow"))
         return "ok", 200
 
     if "message" not in update:
@@ -879,17 +2533,76 @@ def webhook():
     username = m["from"].get("username", "")
     user_repr = f"{user_id} (@{username or 'no_user'})"
 
-    with FileLock(LOCK_PATH):
+    with trace_update(update) as tr:
+        tr["uid"] = user_id
+        set_log_context(uid=user_id)
+        lock = FileLock(LOCK_PATH)
+        with trace_stage("lock_wait"):
+            lock.acquire()
         try:
-            fsm.handle_text(user_id, chat_id, text, user_repr)
+            if "document" in m:
+                fsm.handle_document(user_id, chat_id, m["document"], user_repr)
+            else:
+                fsm.handle_text(user_id, chat_id, text, user_repr)
+        except QuotaExceeded as e:
+            log.warning("Update rejected: %s", e)
+            tg_send(chat_id, "Таблица перегружена запросами. Повторите через минуту.")
         except Exception:
             log.exception("Processing error")
+        finally:
+            lock.release()
     return "ok", 200
 
 @app.route("/health")
 def health():
     return "ok", 200
 
-if __name__ == "__main__":
+
+def _debug_authorized() -> bool:
+    # только из заголовка: URL с токеном оседал бы в access-логах gunicorn и прокси
+    token = request.headers.get("X-Debug-Token", "")
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+@app.route("/debug/profile", methods=["GET", "POST"])
+def debug_profile():
+    """
+    POST ?updates=N&seconds=T — включить cProfile для следующих N апдейтов и/или T секунд.
+    GET ?sort=cumulative&limit=40 — состояние и накопленная статистика.
+    """
+    if not _debug_authorized():
+        return "not found", 404
+    if request.method == "POST":
+        updates = request.args.get("updates", type=int, default=0)
+        seconds = request.args.get("seconds", type=float, default=0)
+        if updates <= 0 and seconds <= 0:
+            updates = 20
+        profiler.arm(updates=updates, seconds=seconds)
+        return jsonify(profiler.status())
+    sort = request.args.get("sort", "cumulative")
+    limit = request.args.get("limit", type=int, default=40)
+    try:
+        report = profiler.report(sort=sort, limit=limit)
+    except KeyError:
+        return "unknown sort key", 400
+    return jsonify({**profiler.status(), "stats": report})
+
+
+@app.route("/debug/slow")
+def debug_slow():
+    """Самые медленные недавние апдейты с разбивкой по этапам (?limit=20)."""
+    if not _debug_authorized():
+        return "not found", 404
+    limit = request.args.get("limit", type=int, default=20)
+    items = sorted(list(SLOW_UPDATES), key=lambda t: t["total_ms"], reverse=True)[:limit]
+    return jsonify({"threshold_ms": SLOW_UPDATE_MS, "updates": items})
+
+def main(argv: Optional[List[str]] = None):
+    # "webhook ..." выполняется раньше, до подключения к таблицам; здесь — только --help и запуск сервера
+    build_cli_parser().parse_args(argv)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])